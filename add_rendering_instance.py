@@ -22,11 +22,16 @@
 # OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.                                          #
 ##########################################################################################
 
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import functools
 import glob
+import itertools
+import mmap
 import os
 import re
 import shutil
+import subprocess
 import sys
 import time
 
@@ -61,6 +66,58 @@ copyList_dirs = [
     "user"
 ]
 copyList_files = [ "openspace.cfg" ]
+# Read-only directories from copyList_dirs that are symlinked to the original 'OpenSpace'
+# directory, rather than copied, when the --shareReadOnly option is used
+shareList_dirs = [
+    "data",
+    "documentation",
+    "shaders"
+]
+# Number of threads used for copying individual files
+copyThreadCount = 8
+
+
+class MultithreadedCopier(ThreadPoolExecutor):
+    """
+    Thread pool that can be passed to shutil.copytree as its copy_function, so that the
+    files within a directory tree are copied concurrently rather than one at a time.
+    The futures of all submitted copies are kept so that errors can be reported after
+    the pool has been shut down.
+    """
+    def __init__(self, max_workers):
+        super().__init__(max_workers=max_workers)
+        self.futures = []
+
+    def copy(self, source, dest):
+        self.futures.append(self.submit(copyFileFast, source, dest))
+
+    def errors(self):
+        return [f.exception() for f in self.futures if f.exception() is not None]
+
+
+def setupArgparse():
+    """
+    Creates and sets up a parser for commandline arguments. This function returns the
+    parsed arguments.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--shareReadOnly",
+        dest="shareReadOnly",
+        action="store_true",
+        help="Symlink the read-only directories (data, documentation, shaders) to the "
+             "original OpenSpace directory instead of copying them.",
+        required=False
+    )
+    args = parser.parse_args()
+    return args
+
+
+def getDirsToCopy(shareReadOnly):
+    # Return the directories that need to be copied, as opposed to symlinked
+    if shareReadOnly:
+        return [d for d in copyList_dirs if d not in shareList_dirs]
+    return copyList_dirs
 
 
 def verifyCorrectOpenSpaceDir(currentDir):
@@ -77,11 +134,8 @@ def verifyCorrectOpenSpaceDir(currentDir):
 def getSubdirs(directory):
     # Return a list of subdirectories within the directory parameter
     try:
-        all_items = os.listdir(directory)
-        subdirectories = [
-            item for item in all_items if os.path.isdir(os.path.join(directory, item))
-        ]
-        return subdirectories
+        with os.scandir(directory) as entries:
+            return [entry.name for entry in entries if entry.is_dir()]
     except FileNotFoundError:
         print(f"Directory '{directory}' does not exist.")
         return []
@@ -96,16 +150,13 @@ def calculateNewInstanceNumber(currentDir):
     other 'OpenSpace_s#' directories and using the next available id (increment by 1).
     If a directory with the proper name exists, but is empty, then that id is used.
     """
-    subs = getSubdirs(currentDir)
-    newInstanceNum = 1
-    for subDir in subs:
-        checkInstanceExisting = f"OpenSpace_s{newInstanceNum}"
-        if subDir == checkInstanceExisting:
-            if any(os.scandir(f"{currentDir}/{subDir}")):
-                newInstanceNum += 1
-            else:
-                break
-    return newInstanceNum
+    for newInstanceNum in itertools.count(1):
+        instanceDir = f"{currentDir}/OpenSpace_s{newInstanceNum}"
+        if not os.path.isdir(instanceDir):
+            return newInstanceNum
+        with os.scandir(instanceDir) as entries:
+            if next(entries, None) is None:
+                return newInstanceNum
 
 
 def getAvailableDiskSpace(directory):
@@ -114,27 +165,84 @@ def getAvailableDiskSpace(directory):
     return free_gb
 
 
+def getTreeSize(directory):
+    """
+    Return the total size in bytes of all files contained (including sub-directories)
+    in the supplied path directory. Symlinks are skipped. The file type and stat
+    results cached on each os.scandir entry are used, so no path strings are joined
+    and no additional stat calls are made per file.
+    """
+    totalUsed = 0
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_symlink():
+                    continue
+                if entry.is_file(follow_symlinks=False):
+                    totalUsed += entry.stat(follow_symlinks=False).st_size
+                elif entry.is_dir(follow_symlinks=False):
+                    totalUsed += getTreeSize(entry.path)
+    except OSError:
+        pass
+    return totalUsed
+
+
 def getUsedDiskSpace(directory="."):
     """
     Return the total size in GB of all files contained (including sub-direcctories)
     in the supplied path directory.
     """
+    return getTreeSize(directory) / (1024 ** 3) # Convert to GB
+
+
+def getUsedDiskSpaceDu(directories):
+    """
+    Return the total size in GB of the supplied list of directories using the system
+    'du' command, which reads directory entries in large batches and is considerably
+    faster than walking the trees from python. Like getUsedDiskSpace, this measures the
+    apparent size of the files (GNU 'du -sb') rather than the disk blocks they occupy,
+    so both paths compare the same quantity against the available space. Returns None
+    if 'du' is not available (e.g. on Windows), does not support '-b', or did not
+    succeed, in which case the caller should fall back to getUsedDiskSpace.
+    """
+    duExec = shutil.which("du")
+    if os.name == "nt" or duExec is None:
+        return None
+    try:
+        result = subprocess.run(
+            [duExec, "-sb", *directories],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True
+        )
+    except OSError:
+        return None
+    if result.returncode != 0:
+        return None
     totalUsed = 0
-    for dirpath, dirnames, filenames in os.walk(directory):
-        for f in filenames:
-            fileHandle = os.path.join(dirpath, f)
-            if not os.path.islink(fileHandle):
-                totalUsed += os.path.getsize(fileHandle)
+    nSizes = 0
+    for line in result.stdout.splitlines():
+        size, _, _ = line.partition("\t")
+        if size.isdigit():
+            totalUsed += int(size)
+            nSizes += 1
+    if nSizes == 0:
+        return None
     return totalUsed / (1024 ** 3) # Convert to GB
 
 
-def verifyEnoughDiskSpace(scriptDir):
+def verifyEnoughDiskSpace(scriptDir, dirsToCopy):
     diskAvailable = getAvailableDiskSpace(scriptDir)
     checkDir = f"{scriptDir}/OpenSpace"
-    usedCalculation = 0
     print(f"Checking OpenSpace directory size...  ", end="", flush=True)
-    for cDir in copyList_dirs:
-        usedCalculation += getUsedDiskSpace(f"{checkDir}/{cDir}")
+    usedCalculation = getUsedDiskSpaceDu([f"{checkDir}/{cDir}" for cDir in dirsToCopy])
+    if usedCalculation is None:
+        # Each directory is sized on its own thread so that the stat calls overlap
+        with ThreadPoolExecutor(max_workers=min(10, len(dirsToCopy))) as pool:
+            usedCalculation = sum(pool.map(
+                getUsedDiskSpace,
+                [f"{checkDir}/{cDir}" for cDir in dirsToCopy]
+            ))
     print(f" {usedCalculation:.2f} GB.")
     bufferSpace = 0.5 # Want at least this much GB space left after copy
     if diskAvailable < (usedCalculation + bufferSpace):
@@ -142,20 +250,41 @@ def verifyEnoughDiskSpace(scriptDir):
 
 
 def verifyOpenSpaceSyncEnvironmentVariable():
-    for key, value in os.environ.items():
-        if key == "OPENSPACE_SYNC":
-            return
-    raise Exception("The environment variable 'OPENSPACE_SYNC' must be defined "
-                    "in order to run multiple instances that share sync/. Note "
-                    "that on Windows this must be defined in the User variables "
-                    "rather than the system variables.")
+    if "OPENSPACE_SYNC" not in os.environ:
+        raise Exception("The environment variable 'OPENSPACE_SYNC' must be defined "
+                        "in order to run multiple instances that share sync/. Note "
+                        "that on Windows this must be defined in the User variables "
+                        "rather than the system variables.")
+
+
+def copyFileFast(source, dest):
+    """
+    Copy a file's contents and metadata, like shutil.copy2. Where the platform provides
+    os.copy_file_range (Linux), the data is copied in-kernel without passing through a
+    user-space buffer, which also allows reflinks or server-side copies on filesystems
+    that support them. Otherwise, or if the kernel refuses the copy (e.g. across
+    filesystems on older kernels), this falls back to shutil.copy2, which already uses
+    the fastest copy method that is available on the platform.
+    """
+    if hasattr(os, "copy_file_range"):
+        try:
+            with open(source, "rb") as fSrc, open(dest, "wb") as fDst:
+                remaining = os.fstat(fSrc.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(fSrc.fileno(), fDst.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+            shutil.copystat(source, dest)
+            return dest
+        except OSError:
+            pass
+    return shutil.copy2(source, dest)
 
 
-def doIndividualDirectoryCopy(source, dest):
+def doIndividualDirectoryCopy(source, dest, copier):
     try:
-        shutil.copytree(source, dest)
-    except FileExistsError:
-        print(f"Copy destination '{dest}' already exists.")
+        shutil.copytree(source, dest, copy_function=copier.copy, dirs_exist_ok=True)
     except FileNotFoundError:
         print(f"Source directory '{source}' does not exist.")
     except PermissionError:
@@ -164,54 +293,141 @@ def doIndividualDirectoryCopy(source, dest):
         print(f"An error occurred: {e}")
 
 
-def copyFilesToNewInstanceDirectory(sourceOpenSpaceDir, newDir):
+def doIndividualDirectoryLink(source, dest):
+    try:
+        os.symlink(os.path.realpath(source), dest, target_is_directory=True)
+    except FileExistsError:
+        print(f"Link destination '{dest}' already exists.")
+    except OSError as e:
+        print(f"Unable to create link '{dest}' to '{source}': {e}")
+
+
+def copyFilesToNewInstanceDirectory(sourceOpenSpaceDir, newDir, shareReadOnly):
+    """
+    Copy all of the directories in copyList_dirs, and files in copyList_files, from the
+    source OpenSpace directory to the new instance directory. The top-level directories
+    are walked concurrently, and the files within them are copied by a shared pool of
+    copy threads. If shareReadOnly is set, the directories in shareList_dirs are
+    symlinked to the source directory instead of being copied.
+    """
+    dirsToCopy = getDirsToCopy(shareReadOnly)
+    if shareReadOnly:
+        print(f"Linking directories:  ", end="", flush=True)
+        for dir in shareList_dirs:
+            doIndividualDirectoryLink(f"{sourceOpenSpaceDir}/{dir}", f"{newDir}/{dir}")
+            print(f"{dir}  ", end="", flush=True)
+        print("")
     print(f"Copying directories:  ", end="", flush=True)
-    for dir in copyList_dirs:
-        doIndividualDirectoryCopy(f"{sourceOpenSpaceDir}/{dir}", f"{newDir}/{dir}")
-        print(f"{dir}  ", end="", flush=True)
-    for file in copyList_files:
-        shutil.copyfile(f"{sourceOpenSpaceDir}/{file}", f"{newDir}/{file}")
+    with MultithreadedCopier(max_workers=copyThreadCount) as copier:
+        with ThreadPoolExecutor(max_workers=len(dirsToCopy)) as dirPool:
+            dirFutures = {
+                dirPool.submit(
+                    doIndividualDirectoryCopy,
+                    f"{sourceOpenSpaceDir}/{dir}",
+                    f"{newDir}/{dir}",
+                    copier
+                ): dir for dir in dirsToCopy
+            }
+            for future in as_completed(dirFutures):
+                print(f"{dirFutures[future]}  ", end="", flush=True)
+        for file in copyList_files:
+            copyFileFast(f"{sourceOpenSpaceDir}/{file}", f"{newDir}/{file}")
     print("")
+    for e in copier.errors():
+        print(f"An error occurred while copying: {e}")
     print("...copying complete.")
 
 
-def replaceStringInConfigFile(filePath, searchTrigger, whatToReplace, replaceWith):
+# Compiled regex patterns, keyed by their pattern
+compiledPatterns = {}
+
+
+def compilePattern(pattern):
+    """
+    Return the compiled bytes regex for a pattern, compiling it only the first time it
+    is requested. The pattern may be given as bytes or as an ASCII string. Patterns
+    that are already compiled are returned unchanged.
+    """
+    if isinstance(pattern, re.Pattern):
+        return pattern
+    if pattern not in compiledPatterns:
+        if isinstance(pattern, str):
+            compiledPatterns[pattern] = re.compile(pattern.encode("ascii"))
+        else:
+            compiledPatterns[pattern] = re.compile(pattern)
+    return compiledPatterns[pattern]
+
+
+# Patterns for locating the per-instance settings in the copied configuration files
+webSocketInterfaceTrigger = compilePattern(
+    rb"Identifier += +\"DefaultWebSocketInterface\""
+)
+webSocketPortPattern = compilePattern(rb"46[0-9][0-9]")
+webrtcIdTrigger = compilePattern(rb"\"webrtcid\"")
+webrtcIdValuePattern = compilePattern(rb":.*,")
+
+
+def replaceStringsInConfigFile(filePath, replacements):
     """
-    Read a file, find a specific text entry, and replace that entry with another string.
-    Then write the new version to the same filename.
+    Read a file, find specific text entries, and replace those entries with other
+    strings. Then write the new version to the same filename. All of the replacements
+    for a file are made with a single read and write.
     Usage:
       - filePath : The absolute path of the file to be read and modified.
-      - searchTrigger : This is a regex string that indicates the beginning of the part
-                        of the file that will be replaced. This string will NOT be
-                        modified. Its purpose is to fine the right location where the
-                        replacement should be made. This is useful, for example, when
-                        replacing a line with a specific port number. Such a line is not
-                        unique to the file, but the searchTrigger can specify replacing
-                        the port number line that is directly below the line specified
-                        by the search Trigger. If a match for the search trigger is not
-                        found, then no text replacement will be made (no file write)
-      - whatToReplace : A regex string for matching the string to replace. This string
-                        will be replaced by the following parameter.
-      - replaceWith : An exact (not regex) string that will replace the match for the
-                      above parameter. The previous parameter and this parameter do not
-                      need to be the same length.
+      - replacements : A list of (searchTrigger, whatToReplace, replaceWith) tuples,
+                       which are applied in order. The file is processed as raw bytes,
+                       so all of these must be ASCII:
+        - searchTrigger : This is a regex (bytes, string or compiled) that indicates the
+                          beginning of the part of the file that will be replaced. This
+                          string will NOT be modified. Its purpose is to fine the right
+                          location where the replacement should be made. This is useful,
+                          for example, when replacing a line with a specific port number.
+                          Such a line is not unique to the file, but the searchTrigger can
+                          specify replacing the port number line that is directly below
+                          the line specified by the search Trigger. If a match for the
+                          search trigger is not found, then this replacement is skipped.
+        - whatToReplace : A regex (bytes, string or compiled) for matching the string to
+                          replace. This string will be replaced by the following
+                          parameter.
+        - replaceWith : An exact (not regex) string that will replace the match for the
+                        above parameter. The previous parameter and this parameter do
+                        not need to be the same length.
+
+    The file is memory-mapped and searched in place. Replacements that have the same
+    length as the text they replace are written directly into the mapping; otherwise
+    the content is copied once into a buffer that is written back to the file.
     """
     try:
-        with open(filePath, "r") as file:
-            content = file.read()
-        triggerMatch = re.search(searchTrigger, content)
-        if triggerMatch != None:
-            contentPostTrigger = content[triggerMatch.end():(triggerMatch.end() + 200)]
-            matchToReplace = re.search(whatToReplace, contentPostTrigger)
-            if matchToReplace != None:
-                newIdx = triggerMatch.end() + matchToReplace.start()
-                newContent = content[0:newIdx] + replaceWith
-                finalIdx = newIdx + len(replaceWith)
-                finalIdx -= (len(replaceWith) - len(matchToReplace.group(0)))
-                newContent += content[finalIdx:]
-                with open(filePath, "w") as file:
-                    file.write(newContent)
-                print(f"Modified config file '{filePath}'")
+        modified = False
+        with open(filePath, "r+b") as file:
+            # An empty file can't be memory-mapped, and has nothing to replace anyway
+            if os.fstat(file.fileno()).st_size == 0:
+                return
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_WRITE) as mapped:
+                content = mapped
+                for searchTrigger, whatToReplace, replaceWith in replacements:
+                    triggerMatch = compilePattern(searchTrigger).search(content)
+                    if triggerMatch == None:
+                        continue
+                    matchToReplace = compilePattern(whatToReplace).search(
+                        content,
+                        triggerMatch.end(),
+                        triggerMatch.end() + 200
+                    )
+                    if matchToReplace == None:
+                        continue
+                    replacement = replaceWith.encode("ascii")
+                    start, end = matchToReplace.span()
+                    if len(replacement) != (end - start) and content is mapped:
+                        content = bytearray(mapped)
+                    content[start:end] = replacement
+                    modified = True
+            if content is not mapped:
+                file.seek(0)
+                file.write(content)
+                file.truncate()
+        if modified:
+            print(f"Modified config file '{filePath}'")
     except FileNotFoundError:
         print(f"Error: Configuration file '{filePath}' does not exist.")
     except PermissionError:
@@ -221,32 +437,29 @@ def replaceStringInConfigFile(filePath, searchTrigger, whatToReplace, replaceWit
 
 
 if __name__ == "__main__":
+    args = setupArgparse()
     scriptDir = os.path.realpath(os.path.dirname(__file__))
     verifyCorrectOpenSpaceDir(scriptDir)
-    verifyEnoughDiskSpace(scriptDir)
+    verifyEnoughDiskSpace(scriptDir, getDirsToCopy(args.shareReadOnly))
     verifyOpenSpaceSyncEnvironmentVariable()
     newInstanceNum = calculateNewInstanceNumber(scriptDir)
     newInstanceDir = f"OpenSpace_s{newInstanceNum}"
 
-    if not os.path.exists(f"{scriptDir}/{newInstanceDir}"):
-        os.mkdir(f"{scriptDir}/{newInstanceDir}")
+    os.makedirs(f"{scriptDir}/{newInstanceDir}", exist_ok=True)
     print(f"Creating instance {newInstanceDir}.")
     copyFilesToNewInstanceDirectory(
         f"{scriptDir}/OpenSpace",
-        f"{scriptDir}/{newInstanceDir}"
+        f"{scriptDir}/{newInstanceDir}",
+        args.shareReadOnly
     )
 
     # Adjust config files for instance number
-    replaceStringInConfigFile(
+    replaceStringsInConfigFile(
         f"{newInstanceDir}/openspace.cfg",
-        r"Identifier += +\"DefaultWebSocketInterface\"",
-        r"46[0-9][0-9]",
-        str(4682 + newInstanceNum)
+        [(webSocketInterfaceTrigger, webSocketPortPattern, str(4682 + newInstanceNum))]
     )
-    replaceStringInConfigFile(
+    replaceStringsInConfigFile(
         f"{newInstanceDir}/config/remote_gstreamer_output.json",
-        r"\"webrtcid\"",
-        r":.*,",
-        f": {str(newInstanceNum)},"
+        [(webrtcIdTrigger, webrtcIdValuePattern, f": {str(newInstanceNum)},")]
     )
     print("Finished.")
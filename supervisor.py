@@ -24,11 +24,16 @@
 
 import argparse
 import asyncio
+import collections
 from enum import Enum, auto
-import functools
 import glob
 import json
+try:
+    import orjson
+except ImportError:
+    orjson = None
 import os
+import pathlib
 import psutil
 import shutil
 import subprocess
@@ -36,18 +41,21 @@ import sys
 if not os.name == "nt":
     import termios
     import tty
+    try:
+        import uvloop
+    except ImportError:
+        uvloop = None
 else:
     import msvcrt
-import time
-from threading import Thread, Timer
+    uvloop = None
 import websockets
 from openspace import Api
 
 
 """
 This Supervisor script continuously runs on a streaming rendering server.
-Upon startup, it starts the WebGUI Frontend served by node.js in a separate terminal,
-and the WebRTC signaling server in another terminal.
+Upon startup, it starts the WebGUI Frontend served by node.js in a separate console,
+and the WebRTC signaling server in another console.
 It communicates with a web backend server via a websocket connection. It sends messages
 only as a response to received commands.
 A separate API document covers the API and functionality in greater detail.
@@ -56,7 +64,20 @@ A separate API document covers the API and functionality in greater detail.
 
 OpenSpaceExecRelativeDir = "bin/RelWithDebInfo"
 OpenSpaceCfgRelativeDir = "config"
+# add_rendering_instance.py gives instance N its own DefaultWebSocketInterface port of
+# OpenSpaceWebSocketBasePort + N. Other server ports are the same for every instance
+OpenSpaceWebSocketBasePort = 4682
+ScriptDir = pathlib.Path(__file__).resolve().parent
+# Directory that the stderr output of each OpenSpace instance is logged to
+LogDir = ScriptDir / "logs"
 Processes = []
+IdleIds = collections.deque() # Ids of the instances in Processes that are IDLE
+# Response sent for every command, filled in with the command's results
+ResultTemplate = {
+    "command": "START",
+    "error": "none",
+    "id": 0
+}
 RunOpenSpaceInShell = False
 
 class State(Enum):
@@ -68,36 +89,91 @@ class State(Enum):
     INVALID = auto()
 
 
+# The states that an instance is allowed to move to from each state. All state changes
+# happen on the event loop, so setState is the only place they need to be checked.
+StateTransitions = {
+    State.IDLE: {State.INITIALIZING},
+    State.INITIALIZING: {State.RUNNING, State.DEINITIALIZING, State.IDLE},
+    State.RUNNING: {State.DEINITIALIZING, State.IDLE},
+    State.DEINITIALIZING: {State.IDLE}
+}
+
+
 class OsProcess:
     """
     Class for running and tracking an individual OpenSpace executable instance,
-    with the state and thread it runs in.
+    with the state and asyncio task it runs in.
+     - `instanceId`: Unique ID for this particular instance of OpenSpace
+     - `baseDir`: The base path of this instance's OpenSpace installation, as a
+                  pathlib.Path
     """
-    def __init__(self):
+    __slots__ = (
+        "instanceId", "baseDir", "executable", "workingDir", "sgctConfigFile",
+        "logFile", "webSocketPort", "openspaceArgs", "state", "handle",
+        "pid_OpenSpace", "pid_ParentShell", "ps_OpenSpace", "ps_ParentShell", "task",
+        "deinitTimer"
+    )
+
+    def __init__(self, instanceId, baseDir):
+        self.instanceId = instanceId
+        self.baseDir = baseDir
+        # The paths used to launch this instance never change, so build them once and
+        # keep them as strings, ready to be passed to the subprocess
+        executable = baseDir / OpenSpaceExecRelativeDir / "OpenSpace.exe"
+        self.executable = str(executable)
+        self.workingDir = str(executable.parent)
+        self.sgctConfigFile = str(
+            baseDir / OpenSpaceCfgRelativeDir / "remote_gstreamer_output.json"
+        )
+        self.logFile = str(LogDir / f"osi-{instanceId}.log")
+        # The one port that only this instance listens on, used to tell when it is ready
+        self.webSocketPort = OpenSpaceWebSocketBasePort + instanceId
+        self.openspaceArgs = []
+        if RunOpenSpaceInShell:
+            if os.name == "nt":
+                self.openspaceArgs.extend(
+                    ["powershell", "$Host.UI.RawUI.WindowTitle='OpenSpace'; "]
+                )
+            else:
+                self.openspaceArgs.extend(["gnome-terminal", "--"])
+        self.openspaceArgs.extend([
+            self.executable,
+            "--config", self.sgctConfigFile,
+            "--profile", "default",
+            "--bypassLauncher"
+        ])
         self.state = State.IDLE
+        self.deinitTimer = None
+        self.clearRunState()
+
+    def clearRunState(self):
+        # Forget everything tied to a particular run of this instance
         self.handle = None
         self.pid_OpenSpace = None
         self.pid_ParentShell = None
-        self.stopSignal = None
-        self.thread = None
+        self.ps_OpenSpace = None
+        self.ps_ParentShell = None
+        self.task = None
+        self.cancelDeinitTimer()
 
     def setState(self, newState):
+        # Entering IDLE puts this instance back on IdleIds. Leaving IDLE only happens
+        # in START, which has already taken the id off of IdleIds.
+        if newState == self.state:
+            return
+        if newState not in StateTransitions[self.state]:
+            raise Exception(f"Invalid state change for OpenSpace ID {self.instanceId}: "
+                            f"{self.state.name} -> {newState.name}")
+        if newState == State.IDLE:
+            IdleIds.append(self.instanceId)
         self.state = newState
 
     def currentState(self):
         return self.state
 
     def currentStateString(self):
-        if self.state == State.IDLE:
-            return "IDLE"
-        elif self.state == State.INITIALIZING:
-            return "INITIALIZING"
-        elif self.state == State.RUNNING:
-            return "RUNNING"
-        elif self.state == State.DEINITIALIZING:
-            return "DEINITIALIZING"
-        else:
-            return "INVALID"
+        # The State member names are the strings used in the API
+        return self.state.name
 
     def setProcessHandle(self, handle):
         self.handle = handle
@@ -117,20 +193,38 @@ class OsProcess:
     def pidParentShell(self):
         return self.pid_ParentShell
 
-    def assignStopSignal(self, signal):
-        self.stopSignal = signal
+    def setOpenSpaceProcess(self, proc):
+        self.ps_OpenSpace = proc
+
+    def openSpaceProcess(self):
+        return self.ps_OpenSpace
+
+    def setParentShellProcess(self, proc):
+        self.ps_ParentShell = proc
 
-    def hasStopSignaled(self):
-        return self.stopSignal.is_set()
+    def parentShellProcess(self):
+        return self.ps_ParentShell
 
-    def setThread(self, thread):
-        self.thread = thread
+    def setTask(self, task):
+        self.task = task
 
-    def thread(self):
-        return self.thread
+    def getTask(self):
+        return self.task
+
+    def setDeinitTimer(self, timer):
+        # Replaces (and cancels) any grace period timer from an earlier STOP
+        self.cancelDeinitTimer()
+        self.deinitTimer = timer
+
+    def cancelDeinitTimer(self):
+        if self.deinitTimer is not None:
+            self.deinitTimer.cancel()
+            self.deinitTimer = None
 
     def reset(self):
-        self.__init__()
+        # Go through setState so that IdleIds stays correct
+        self.setState(State.IDLE)
+        self.clearRunState()
 
 
 def setupArgparse():
@@ -166,7 +260,7 @@ def setupArgparse():
     parser.add_argument(
         "--capacity",
         dest="renderCapacity",
-        type=str,
+        type=int,
         help="The max number of simultaneous openspace instances.",
         default=3,
         required=False
@@ -175,212 +269,373 @@ def setupArgparse():
     return args
 
 
-def runOpenspace(executable, baseDir, instanceId):
+async def runOpenspace(instanceId):
     """
-    Run Openspace using the streaming SGCT configuration.
-     - `executable`: The path to the OpenSpace executable that should be run
-     - `baseDir`: The base path of the OpenSpace installation
-     - `stopEvents_instance`: Event used to signal that this OpenSpace instance should stop
+    Run Openspace using the streaming SGCT configuration, and wait until it has stopped.
      - 'instanceId': Unique ID for this particular instance of OpenSpace
     """
     global Processes
     print(f"Starting OpenSpace ID {instanceId}")
-    workingDirectory = os.path.dirname(os.path.normpath(executable))
-    sgctConfigFile = os.path.normpath(f"{baseDir}/config/remote_gstreamer_output.json")
-    openspaceArgs = []
-    if RunOpenSpaceInShell:
-        openspaceArgs = ["start"]
-        if os.name == "nt":
-            openspaceArgs.extend(["powershell", "$Host.UI.RawUI.WindowTitle='OpenSpace'; "])
+    instance = Processes[instanceId]
+    try:
+        if RunOpenSpaceInShell:
+            process = await asyncio.create_subprocess_exec(
+                *instance.openspaceArgs,
+                cwd=instance.workingDir,
+                **newConsoleArgs()
+            )
         else:
-            openspaceArgs.append("gnome-terminal")
-    openspaceArgs.extend([
-        os.path.normpath(executable),
-        "--config", sgctConfigFile,
-        "--profile", "default",
-        "--bypassLauncher"
-    ])
-    process = subprocess.Popen(
-        openspaceArgs,
-        shell=RunOpenSpaceInShell,
-        cwd=workingDirectory,
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.PIPE
-    )
+            # Nothing reads OpenSpace's stderr while it runs, so send it to a log file
+            # rather than a pipe that would stall OpenSpace once it fills up
+            LogDir.mkdir(exist_ok=True)
+            with open(instance.logFile, "ab", buffering=0) as logFile:
+                process = await asyncio.create_subprocess_exec(
+                    *instance.openspaceArgs,
+                    cwd=instance.workingDir,
+                    stdout=asyncio.subprocess.DEVNULL,
+                    stderr=logFile
+                )
+    except OSError as e:
+        # e.g. this instance's OpenSpace_s# copy doesn't exist, so the slot can't be used
+        print(f"Unable to start OpenSpace ID {instanceId}: {e}")
+        if instance.getTask() is asyncio.current_task():
+            instance.setState(State.IDLE)
+            print(f"OpenSpace ID {instanceId} INITIALIZING -> IDLE")
+        return
+
+    # A STOP may have arrived while the process was being created. It had no process
+    # to terminate then, so the new process has to be stopped here instead
+    ownsInstance = instance.getTask() is asyncio.current_task()
+    if not ownsInstance or instance.currentState() != State.INITIALIZING:
+        print(f"OpenSpace ID {instanceId} was stopped while starting, terminating it")
+        await terminateProcessTree(process)
+        if ownsInstance:
+            instance.setState(State.IDLE)
+        return
 
     if RunOpenSpaceInShell:
-        time.sleep(4) #Wait for it to start OpenSpace
         Processes[instanceId].setPidOpenSpace(None)
         Processes[instanceId].setPidParentShell(None)
-        for proc in psutil.process_iter(['pid', 'name', 'cmdline']):
-            try:
-                # Check if the process command matches the target
-                if not proc.info:
-                    continue
-                if proc.info['name'].lower() == 'powershell.exe':
-                    parent = psutil.Process(proc.pid)
-                    children = parent.children(recursive=False)
-                    for child in children:
-                        if child.name():
-                            if child.name().lower() == "openspace.exe":
-                                msg = f"Found powershell pid {proc.pid}" \
-                                    f" with OpenSpace.exe child ({child.pid})."
-                                Processes[instanceId].setPidOpenSpace(child.pid)
-                                Processes[instanceId].setPidParentShell(proc.pid)
-                                print(msg)
-                                break
-            except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
-                print("exception with ps info")
-                pass
+        Processes[instanceId].setOpenSpaceProcess(None)
+        Processes[instanceId].setParentShellProcess(None)
+        # Wait for the shell to start OpenSpace, checking again with increasing delays
+        child = findOpenSpaceChild(process.pid)
+        for delay in (0.25, 0.5, 1.0, 2.0, 4.0):
+            if child is not None:
+                break
+            await asyncio.sleep(delay)
+            child = findOpenSpaceChild(process.pid)
+        if instance.getTask() is not asyncio.current_task():
+            # A STOP arrived during the lookup and could not find this OpenSpace to
+            # terminate it, and the slot has been reset since. Stop what was started
+            # without touching the slot, which may already belong to a new run
+            print(f"OpenSpace ID {instanceId} was stopped while starting, terminating it")
+            if child is not None:
+                try:
+                    child.kill()
+                except psutil.NoSuchProcess:
+                    pass
+            await terminateProcessTree(process)
+            return
+        try:
+            if child is not None:
+                parent = child.parent()
+                Processes[instanceId].setPidOpenSpace(child.pid)
+                Processes[instanceId].setOpenSpaceProcess(child)
+                if parent is not None:
+                    Processes[instanceId].setPidParentShell(parent.pid)
+                    Processes[instanceId].setParentShellProcess(parent)
+                print(f"Found powershell pid {Processes[instanceId].pidParentShell()} "
+                      f"with OpenSpace.exe child ({child.pid}).")
+            else:
+                print(f"Unable to find OpenSpace.exe started for ID {instanceId}")
+        except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
+            print("exception with ps info")
     else:
         Processes[instanceId].setProcessHandle(process)
-    time.sleep(10)
 
-    async def mainLoop():
-        # Loop for waiting until Openspace has initialized
+    # Wait until OpenSpace has initialized and its own websocket port accepts
+    # connections. The 4681 API port is shared by all instances, so it can't be used to
+    # tell whether this particular instance is up
+    ownProcess = None if RunOpenSpaceInShell else process
+    if await waitForPort("localhost", instance.webSocketPort, 30.0, ownProcess):
         print(f"Establishing API connection for ID {instanceId}...")
         os_api = Api("localhost", 4681)
         os_api.connect()
         openspace = await os_api.singleReturnLibrary()
+        # Unless a STOP has arrived while it was starting up
+        if Processes[instanceId].currentState() == State.INITIALIZING:
+            Processes[instanceId].setState(State.RUNNING)
+            print(f"OpenSpace ID {instanceId} INITIALIZING -> RUNNING")
+    elif RunOpenSpaceInShell:
+        print(f"OpenSpace ID {instanceId} did not open its websocket port in time")
+        if Processes[instanceId].getTask() is asyncio.current_task():
+            await terminateOpenSpaceInstanceInShell(instanceId)
+            Processes[instanceId].reset()
+        return
+    elif process.returncode is None:
+        # Still not reachable, so kill it and go back to IDLE once it has exited
+        print(f"OpenSpace ID {instanceId} did not open its websocket port in time")
+        process.kill()
+
+    # Wait until this OpenSpace instance has stopped (e.g. via the frontend gui). In
+    # shell mode OpenSpace is not our own child process, so wait on its psutil handle
+    psOpenSpace = Processes[instanceId].openSpaceProcess()
+    if RunOpenSpaceInShell and psOpenSpace is not None:
+        try:
+            await asyncio.to_thread(psOpenSpace.wait)
+        except psutil.NoSuchProcess:
+            pass
+    else:
+        await process.wait()
+    # Leave the state alone if this instance has since been reset and started again
+    if Processes[instanceId].getTask() is asyncio.current_task():
+        Processes[instanceId].setState(State.IDLE)
+        print(f"OpenSpace ID {instanceId} RUNNING -> IDLE")
 
-    asyncio.new_event_loop().run_until_complete(mainLoop())
-    Processes[instanceId].setState(State.RUNNING)
-    print(f"OpenSpace ID {instanceId} INITIALIZING -> RUNNING")
 
-    async def waitForInstanceToStopByPid(procPid):
-        while psutil.pid_exists(procPid):
-            await asyncio.sleep(2.0)
+async def waitForPort(host, port, timeout, process=None):
+    """
+    Poll until a TCP connection can be opened to a port served by OpenSpace, waiting a
+    little longer between each attempt. Returns True once the port accepts a
+    connection, or False if it did not within the timeout.
+     - `host`: The host OpenSpace is running on
+     - `port`: The port to connect to
+     - `timeout`: The maximum number of seconds to wait
+     - `process`: If provided, the asyncio process serving the port. Polling stops
+                  early if it exits.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    delay = 0.1
+    while True:
+        if process is not None and process.returncode is not None:
+            return False
+        try:
+            _, writer = await asyncio.open_connection(host, port)
+            writer.close()
+            await writer.wait_closed()
+            return True
+        except OSError:
+            pass
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            return False
+        await asyncio.sleep(min(delay, remaining))
+        delay = min(delay * 2, 3.2)
 
-    async def waitForInstanceToStopByHandle(procHandle):
-        while procHandle.poll() is None:
-            await asyncio.sleep(2.0)
 
-    # Wait until this OpenSpace instance has stopped (e.g. via the frontend gui)
-    if RunOpenSpaceInShell:
-        asyncio.new_event_loop().run_until_complete(
-            waitForInstanceToStopByPid(Processes[instanceId].pidOpenSpace())
-        )
-    else:
-        asyncio.new_event_loop().run_until_complete(
-            waitForInstanceToStopByHandle(process)
-        )
-    Processes[instanceId].setState(State.IDLE)
-    print(f"OpenSpace ID {instanceId} RUNNING -> IDLE")
+def findOpenSpaceChild(launcherPid):
+    """
+    Return the psutil.Process of the OpenSpace executable that was started (directly or
+    through a shell) by the process with pid `launcherPid`, or None if it isn't running
+    yet. Only the launcher's own descendants are checked. If the launcher has already
+    exited, which happens when it only ran 'start', the OpenSpace processes that are
+    not yet tracked by any instance are searched for by name instead.
+     - `launcherPid`: The pid of the process that was spawned to run OpenSpace
+    """
+    try:
+        candidates = psutil.Process(launcherPid).children(recursive=True)
+    except psutil.NoSuchProcess:
+        trackedPids = [p.pidOpenSpace() for p in Processes]
+        candidates = [
+            proc for proc in psutil.process_iter(['name'])
+            if proc.pid not in trackedPids
+        ]
+    for candidate in candidates:
+        try:
+            if candidate.name().lower() == "openspace.exe":
+                return candidate
+        except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
+            continue
+    return None
 
 
-def setTimerForDeinitializationPeriod(idStopped):
+def endDeinitializationPeriod(idStopped):
+    """
+    Called by the event loop when the deinitialization grace period of a stopped
+    instance is over. Sets the instance back to IDLE (unless it already got there by
+    itself).
+     - `idStopped`: The id of the instance that was stopped
+    """
     global Processes
-    Processes[idStopped].setState(State.IDLE)
+    Processes[idStopped].deinitTimer = None
+    if Processes[idStopped].currentState() == State.DEINITIALIZING:
+        Processes[idStopped].setState(State.IDLE)
     print("timer expired")
 
 
-async def processMessage(websocket, message, openspaceBaseDir):
+def jsonLoads(message):
+    # Parse a JSON message, using orjson if it is installed
+    if orjson:
+        return orjson.loads(message)
+    return json.loads(message)
+
+
+def jsonDumps(obj):
+    # Serialize an object to a JSON string, using orjson if it is installed
+    if orjson:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj)
+
+
+async def startCommand(websocket, json_data, result):
+    """
+    START: run OpenSpace in the next IDLE instance, replying with its id
+    """
+    startId = IdleIds.popleft() if IdleIds else -1
+    if startId != -1:
+        # A grace period timer left over from the previous run must not end this one
+        Processes[startId].cancelDeinitTimer()
+        Processes[startId].setTask(asyncio.create_task(runOpenspace(startId)))
+        Processes[startId].setState(State.INITIALIZING)
+    else:
+        result['error'] = "no available slots"
+    result['id'] = startId
+    await sendMessage(websocket, jsonDumps(result))
+
+
+async def stopCommand(websocket, json_data, result):
+    """
+    STOP: terminate the OpenSpace instance with the requested id
+    """
+    idToStop = json_data['id']
+    result['id'] = idToStop
+    if idToStop < len(Processes):
+        if Processes[idToStop].currentState() == State.IDLE:
+            result['error'] = "not running"
+        await sendMessage(websocket, jsonDumps(result))
+        if Processes[idToStop].currentState() != State.IDLE:
+            Processes[idToStop].setState(State.DEINITIALIZING)
+            Processes[idToStop].setDeinitTimer(asyncio.get_running_loop().call_later(
+                5.0, endDeinitializationPeriod, idToStop
+            ))
+            if RunOpenSpaceInShell:
+                await terminateOpenSpaceInstanceInShell(idToStop)
+                Processes[idToStop].reset()
+            else:
+                await terminateOpenSpaceInstance(idToStop)
+    else:
+        result['error'] = "invalid id"
+        await sendMessage(websocket, jsonDumps(result))
+
+
+async def statusCommand(websocket, json_data, result):
+    """
+    STATUS: reply with the state of the instance with the requested id
+    """
+    idForStatus = json_data['id']
+    if idForStatus < len(Processes) and idForStatus >= 0:
+        result['status'] = Processes[idForStatus].currentStateString()
+    else:
+        result['status'] = State.INVALID.name
+        result['error'] = "invalid id"
+    await sendMessage(websocket, jsonDumps(result))
+
+
+async def statusAllCommand(websocket, json_data, result):
+    """
+    STATUS_ALL: reply with the state of every instance, indexed by id
+    """
+    result['status'] = [p.currentStateString() for p in Processes]
+    await sendMessage(websocket, jsonDumps(result))
+
+
+async def serverStatusCommand(websocket, json_data, result):
+    """
+    SERVER_STATUS: reply with the number of running instances and the total capacity
+    """
+    result['running'] = len(Processes) - len(IdleIds)
+    result['total'] = len(Processes)
+    await sendMessage(websocket, jsonDumps(result))
+
+
+CommandHandlers = {
+    "START": startCommand,
+    "STOP": stopCommand,
+    "STATUS": statusCommand,
+    "STATUS_ALL": statusAllCommand,
+    "SERVER_STATUS": serverStatusCommand
+}
+
+
+async def processMessage(websocket, message):
     """
     Handle JSON messages from web backend, execute command, then send response
     """
-    global Processes
     try:
-        json_data = json.loads(message)
+        json_data = jsonLoads(message)
         command = json_data['command']
         print(f"Received command: {command}")
-        result = json.loads("""{
-            "command": "START",
-            "error": "none",
-            "id": 0
-        }""")
-        result['command'] = command # echo the command back
-        if command == "START":
-            startId = -1
-            for i in range(0, len(Processes)):
-                if Processes[i].currentState() == State.IDLE:
-                    startId = i
-                    break
-            if startId != -1:
-                if startId > 0:
-                    openspaceBaseDir = f"{openspaceBaseDir}/../OpenSpace_s{startId}"
-                Processes[startId].setThread(Thread(
-                        target=runOpenspace,
-                        args= [
-                            f"{openspaceBaseDir}/{OpenSpaceExecRelativeDir}/OpenSpace.exe",
-                            openspaceBaseDir,
-                            startId
-                        ]
-                    )
-                )
-                Processes[startId].thread.daemon = True
-                Processes[startId].thread.start()
-                Processes[startId].setState(State.INITIALIZING)
-            else:
-                result['error'] = "no available slots"
-            result['id'] = startId
-            await sendMessage(websocket, json.dumps(result))
-        elif command == "STOP":
-            idToStop = json_data['id']
-            result['id'] = idToStop
-            if idToStop < len(Processes):
-                if Processes[idToStop].currentState() == State.IDLE:
-                    result['error'] = "not running"
-                await sendMessage(websocket, json.dumps(result))
-                if Processes[idToStop].currentState() != State.IDLE:
-                    Processes[idToStop].setState(State.DEINITIALIZING)
-                    timer = Timer(5.0, setTimerForDeinitializationPeriod, args=(idToStop,))
-                    timer.start()
-                    if RunOpenSpaceInShell:
-                        await terminateOpenSpaceInstanceInShell(idToStop)
-                        Processes[idToStop].reset()
-                    else:
-                        terminateOpenSpaceInstance(idToStop)
-            else:
-                result['error'] = "invalid id"
-                await sendMessage(websocket, json.dumps(result))
-        elif command == "STATUS":
-            idForStatus = json_data['id']
-            if idForStatus < len(Processes) and idForStatus >= 0:
-                result['status'] = Processes[idForStatus].currentStateString()
-            else:
-                result['status'] = State.INVALID
-                result['error'] = "invalid id"
-            await sendMessage(websocket, json.dumps(result))
-        elif command == "SERVER_STATUS":
-            nRunning = 0
-            for i in range(0, len(Processes)):
-                if Processes[i].currentState() != State.IDLE:
-                    nRunning += 1
-            result['running'] = nRunning
-            result['total'] = len(Processes)
-            await sendMessage(websocket, json.dumps(result))
-        else:
+        handler = CommandHandlers.get(command)
+        if handler is None:
             print(f"Invalid message received: '{message}'")
             await sendMessage(
                 websocket,
-                json.dumps({"error": f"invalid message received: {command}"})
+                jsonDumps({"error": f"invalid message received: {command}"})
             )
-    except json.JSONDecodeError as e:
+            return
+        result = ResultTemplate.copy()
+        result['command'] = command # echo the command back
+        await handler(websocket, json_data, result)
+    except json.JSONDecodeError as e: # orjson's JSONDecodeError is a subclass
         print(f"JSON decode error {e}")
         await sendMessage(
             websocket,
-            json.dumps({"error": "json decode error"})
+            jsonDumps({"error": "json decode error"})
+        )
+    except (KeyError, TypeError, ValueError) as e:
+        # A missing or wrongly typed field only fails this message, the connection
+        # stays open for the next one
+        print(f"Invalid message received: '{message}' ({type(e).__name__}: {e})")
+        await sendMessage(
+            websocket,
+            jsonDumps({"error": f"invalid message received: {type(e).__name__}: {e}"})
         )
 
 
-def terminateOpenSpaceInstance(id):
+async def terminateOpenSpaceInstance(id, timeout=3.0):
+    """
+    Ask an OpenSpace instance to terminate, and kill it if it has not exited within the
+    timeout.
+     - `id`: The id of the instance to terminate
+     - `timeout`: The number of seconds to wait for it to exit before killing it
+    """
     c = Processes[id].currentState()
     if c == State.INITIALIZING or c == State.RUNNING or c == State.DEINITIALIZING:
-        Processes[id].getHandle().kill()
+        process = Processes[id].getHandle()
+        if process is None or process.returncode is not None:
+            return
+        try:
+            process.terminate()
+            await asyncio.wait_for(process.wait(), timeout)
+        except asyncio.TimeoutError:
+            print(f"OpenSpace ID {id} did not exit after {timeout} s, killing it")
+            process.kill()
+            await process.wait()
+        except ProcessLookupError:
+            pass
 
 
 async def terminateOpenSpaceInstanceInShell(id):
     c = Processes[id].currentState()
     if c == State.INITIALIZING or c == State.RUNNING or c == State.DEINITIALIZING:
-        if Processes[id].pidOpenSpace():
-            p = psutil.Process(Processes[id].pidParentShell())
-            terminateProcessByPid(Processes[id].pidParentShell())
-            p.kill()
-            p.terminate()
-            await asyncio.sleep(2)
-            p = psutil.Process(Processes[id].pidOpenSpace())
-            p.kill()
-            p.terminate()
+        psOpenSpace = Processes[id].openSpaceProcess()
+        if psOpenSpace:
+            psShell = Processes[id].parentShellProcess()
+            if psShell:
+                try:
+                    psShell.terminate()
+                    await asyncio.sleep(0.2)
+                except psutil.NoSuchProcess:
+                    pass
+            try:
+                psOpenSpace.kill()
+                await asyncio.to_thread(psOpenSpace.wait, 5)
+            except psutil.NoSuchProcess:
+                pass
+            except psutil.TimeoutExpired:
+                print(f"OpenSpace pid {psOpenSpace.pid} did not exit after being killed")
         else:
             print(f"Unable to terminate OpenSpace via its parent shell pid "
                   f"{Processes[id].pidParentShell()}")
@@ -391,170 +646,142 @@ async def sendMessage(websocket, message):
     await websocket.send(message)
 
 
-async def receiveProcess(websocket, openspaceBaseDir):
+async def receiveProcess(websocket):
+    # Keep handling messages on this connection until the client closes it
     try:
-        message = await websocket.recv()
-        await processMessage(
-            websocket,
-            message,
-            openspaceBaseDir
-        )
+        async for message in websocket:
+            await processMessage(websocket, message)
     except websockets.ConnectionClosed:
-        print("Connection closed")
+        pass
+    print("Connection closed")
 
 
-async def websocketServer(stopEvent_main, openspaceBaseDir):
-    boundHandler = functools.partial(
-        receiveProcess,
-        openspaceBaseDir=openspaceBaseDir
-    )
-    async with websockets.serve(boundHandler, "localhost", 4699):
+async def websocketServer(stopEvent_main):
+    async with websockets.serve(receiveProcess, "localhost", 4699):
         print("WebSocket server started on ws://localhost:4699")
         await stopEvent_main.wait()  # Wait until stop event is set
     print(f"Quitting websocketServer.")
 
 
-def keyPressedUnix():
-    fd = sys.stdin.fileno()
-    old_settings = termios.tcgetattr(fd)
-    try:
-        tty.setraw(sys.stdin.fileno())
-        return sys.stdin.read(1) #non-blocking single-char read
-    finally:
-        termios.tcsetattr(fd, termios.TCSADRAIN, old_settings)
-
-
-def keyPressedWin():
-    return msvcrt.kbhit()
-
-
-def keyPressed():
+def newConsoleArgs():
+    """
+    Return the subprocess keyword arguments for running a process in a console of its
+    own, without going through a shell and 'start'. On Windows the process gets a new
+    console window that shows its output. Elsewhere it is started in a new session,
+    detached from the supervisor's terminal, and its output is discarded.
+    """
     if os.name == "nt":
-        return keyPressedWin()
-    else:
-        return keyPressedUnix()
+        return {"creationflags": subprocess.CREATE_NEW_CONSOLE}
+    return {
+        "start_new_session": True,
+        "stdout": subprocess.DEVNULL,
+        "stderr": subprocess.DEVNULL
+    }
 
 
 async def webGuiFrontendServer(stopEvent, workingDir):
     """
-    Start WebGUI Frontend node.js server in the workingDir in a separate terminal.
+    Start WebGUI Frontend node.js server in the workingDir in a separate console.
     Runs until the stopEvent signal is set.
     """
-    execPath = os.path.normpath(workingDir)
-    execArgs = ["start", "powershell", "npm", "start"]
-    if os.name != "nt":
-        execArgs[1] = "gnome-terminal"
-    process = subprocess.Popen(
-        execArgs,
-        shell=True,
-        cwd=execPath,
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.PIPE)
+    execArgs = [shutil.which("npm") or "npm", "start"]
+    process = await asyncio.create_subprocess_exec(
+        *execArgs,
+        cwd=workingDir,
+        **newConsoleArgs())
     print("Started WebGUI Frontend server.")
     # Wait for the stop signal while the process runs
-    while not stopEvent.is_set():
-        await asyncio.sleep(1)  # Periodically check for the stop signal
+    await stopEvent.wait()
 
-    # Stop signal received, terminate the subprocess
-    await terminateProcess("node.exe", ["start"])
-    await terminateProcess("node.exe", ["webpack-dev-server"])
+    # Stop signal received, terminate the subprocess and the node processes it started
+    await terminateProcessTree(process)
     print("Quit WebGUI Frontend server.")
 
 
 async def signalingServer(stopEvent, workingDir):
     """
-    Start WebRTC signaling server in the workingDir in a separate terminal.
+    Start WebRTC signaling server in the workingDir in a separate console.
     Runs until the stopEvent signal is set.
     """
-    execPath = os.path.normpath(workingDir)
-    execArgs = ["start"]
-    if os.name == "nt":
-        execArgs.extend(["powershell", "$Host.UI.RawUI.WindowTitle='signalingserver'; "])
-    else:
-        execArgs.append("gnome-terminal")
-    execArgs.extend(["node", "signalingserver"])
-    process = subprocess.Popen(
-        execArgs,
-        shell=True,
-        cwd=execPath,
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.PIPE)
+    execArgs = [shutil.which("node") or "node", "signalingserver"]
+    process = await asyncio.create_subprocess_exec(
+        *execArgs,
+        cwd=workingDir,
+        **newConsoleArgs())
     print("Started signalingserver.")
     # Wait for the stop signal while the process runs
-    while not stopEvent.is_set():
-        await asyncio.sleep(1)  # Periodically check for the stop signal
+    await stopEvent.wait()
 
     # Stop signal received, terminate the subprocess
-    await terminateProcess("node.exe", ["signalingserver"])
+    await terminateProcessTree(process)
     print("Quit signalingserver.")
 
 
-async def terminateProcess(processName, processElems, ignoreElems=[]):
+async def terminateProcessTree(process, timeout=3.0):
     """
-    Terminate a process by its commandline elements
-     - `processName`: The exact name of the process executable
-     - `processElems`: An array of strings containing the commandline elements of the
-                       running process. For a process to be terminated, its 'cmdline'
-                       properties must contain ALL of the string elements in this array.
-     - `ignoreElems`: An array of elements that will disqualify a process from being
-                      terminated. If the process' cmdline elements contain any one of
-                      these, then it will not be terminated.
+    Terminate a process that was started by the supervisor, along with all of the
+    processes it started in turn (e.g. npm starts node, which starts webpack). Any
+    that have not exited within the timeout are killed.
+     - `process`: The asyncio process that was started
+     - `timeout`: The number of seconds to wait for the processes to exit
     """
-    processElems = [elem.lower() for elem in processElems]
-    ignoreElems = [elem.lower() for elem in ignoreElems]
-    # Iterate through all running processes
-    for proc in psutil.process_iter(['pid', 'name', 'cmdline']):
+    try:
+        parent = psutil.Process(process.pid)
+        tree = parent.children(recursive=True) + [parent]
+    except psutil.NoSuchProcess:
+        tree = []
+    for proc in tree:
         try:
-            # Check if the process command matches the target
-            if not proc.info:
-                continue
-            if proc.info['name'].lower() != processName.lower():
-                continue
-            iterProcElems = proc.info['cmdline']
-            fullName = f"{processName} {iterProcElems}"
-            iterProcElems = [elem.lower() for elem in iterProcElems]
-            if iterProcElems == None or len(iterProcElems) == 0:
-                continue
-            proceedWithTermination = True
-            for ignore in ignoreElems:
-                if any(ignore in iterProcElem for iterProcElem in iterProcElems):
-                    proceedWithTermination = False
-            if len(processElems) > 0:
-                for elem in processElems:
-                    if not any(elem in iterProcElem for iterProcElem in iterProcElems):
-                        proceedWithTermination = False
-            if proceedWithTermination:
-                if RunOpenSpaceInShell:
-                    terminateProcessByPid(proc.info['pid'])
-                else:
-                    subprocess.check_output(f"Taskkill /PID {proc.info['pid']} /F")
-                print(f"Terminated {fullName} with PID: {proc.info['pid']}")
-                await asyncio.sleep(0.5) # Give it time to terminate
-        except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
+            proc.terminate()
+        except psutil.NoSuchProcess:
             pass
-
-
-def terminateProcessByPid(pidToTerminate):
-    """
-    Terminate a process by its pid. Some processes don't seem to respond to psutil.kill,
-    so this function uses a windows 'Taskkill /PID # /F' command.
-     - `pidToTerminate`: The process pid that will be terminated.
-    """
-    subprocess.check_output(f"Taskkill /PID {pidToTerminate} /F")
+    _, alive = await asyncio.to_thread(psutil.wait_procs, tree, timeout)
+    for proc in alive:
+        try:
+            proc.kill()
+        except psutil.NoSuchProcess:
+            pass
+    await process.wait()
 
 
 async def shutdownOnKeypress(stopEvent):
     """
-    If 'q' key is pressed, signal the stopEvent which is used to stop other processes
+    If 'q' key is pressed, signal the stopEvent which is used to stop other processes.
+    On Windows a worker thread blocks on the next console keypress. Elsewhere, stdin is
+    put in cbreak mode and registered with the event loop, so this only wakes up when a
+    key arrives.
     """
-    while True:
-        if keyPressed():
-            key = str(msvcrt.getch())
-            if key == "b'q'" or key == "b'Q'":
+    if os.name == "nt":
+        while not stopEvent.is_set():
+            key = await asyncio.to_thread(msvcrt.getwch)
+            if key == "q" or key == "Q":
                 print("Shutting down...")
                 stopEvent.set()
-                break
-        await asyncio.sleep(0.25)
+        return
+
+    fd = sys.stdin.fileno()
+    loop = asyncio.get_running_loop()
+
+    def onKeyPressed():
+        # Read everything that is available, in case several keys arrived at once
+        keys = os.read(fd, 16)
+        if keys == b"":
+            # stdin was closed, so no further keypresses can arrive
+            loop.remove_reader(fd)
+        elif b"q" in keys or b"Q" in keys:
+            print("Shutting down...")
+            stopEvent.set()
+
+    oldSettings = termios.tcgetattr(fd) if os.isatty(fd) else None
+    try:
+        if oldSettings is not None:
+            tty.setcbreak(fd)
+        loop.add_reader(fd, onKeyPressed)
+        await stopEvent.wait()
+    finally:
+        loop.remove_reader(fd)
+        if oldSettings is not None:
+            termios.tcsetattr(fd, termios.TCSADRAIN, oldSettings)
 
 
 async def shutdownTaskAndVerify(taskHandle, taskName):
@@ -565,7 +792,7 @@ async def shutdownTaskAndVerify(taskHandle, taskName):
         print(f"Task '{taskName}' clean shutdown.")
 
 
-async def mainAsync(openspaceBaseDir, openspaceFrontendDir, signalingServerDir):
+async def mainAsync(openspaceFrontendDir, signalingServerDir):
     """
     Main asynchronous loop to run:
       server for websocket comms with web backend
@@ -573,18 +800,15 @@ async def mainAsync(openspaceBaseDir, openspaceFrontendDir, signalingServerDir):
       WebRTC signaling server
     After starting these processes, waits for a keypress to initiate shutdown.
     Parameters:
-      - openspacceBaseDir : absolute path to the base dir of the OpenSpace installation
       - openspaceFrontendDir : absolute path to the base dir of WebGUI Frontend
       - signalingServerDir : absolute path to the directory where the signaling server
                              code resides (currently within the WebGUI Frontend dir)
     """
     global Processes
     stopEvent_main = asyncio.Event()
-    for i in range(0, len(Processes)):
-        Processes[i].assignStopSignal(asyncio.Event())
     # Start the websocket server
     websocket_task = asyncio.create_task(
-        websocketServer(stopEvent_main, openspaceBaseDir)
+        websocketServer(stopEvent_main)
     )
     # Start the webGUI frontend node.js server
     webGuiFrontend_task = asyncio.create_task(
@@ -600,13 +824,17 @@ async def mainAsync(openspaceBaseDir, openspaceFrontendDir, signalingServerDir):
     await shutdown_task
 
     print("Finished waiting for shutdown_task")
-    # Kill any OpenSpace instances that are running
-    for i in range(0, len(Processes)):
-        if RunOpenSpaceInShell:
-            await terminateOpenSpaceInstanceInShell(i)
+    # Stop any OpenSpace instances that are running, all at the same time
+    if RunOpenSpaceInShell:
+        await asyncio.gather(
+            *(terminateOpenSpaceInstanceInShell(i) for i in range(0, len(Processes)))
+        )
+        for i in range(0, len(Processes)):
             Processes[i].reset()
-        else:
-            terminateOpenSpaceInstance(i)
+    else:
+        await asyncio.gather(
+            *(terminateOpenSpaceInstance(i) for i in range(0, len(Processes)))
+        )
     await shutdownTaskAndVerify(websocket_task, "websocket server")
     await shutdownTaskAndVerify(webGuiFrontend_task, "webGuiFrontend server")
     await shutdownTaskAndVerify(signalingserver_task, "signaling server")
@@ -615,23 +843,33 @@ async def mainAsync(openspaceBaseDir, openspaceFrontendDir, signalingServerDir):
 
 if __name__ == "__main__":
     args = setupArgparse()
+    # All paths are built once here, relative to the directory of this script
+    openspaceBaseDir = pathlib.Path(os.path.normpath(ScriptDir / args.osdir))
     for i in range(0, args.renderCapacity):
-        Processes.append(OsProcess())
+        # Instance 0 uses the main installation, the others use the copies made by
+        # add_rendering_instance.py next to it
+        if i == 0:
+            Processes.append(OsProcess(i, openspaceBaseDir))
+        else:
+            Processes.append(OsProcess(i, openspaceBaseDir.parent / f"OpenSpace_s{i}"))
+    IdleIds.extend(range(0, len(Processes)))
     print(f"Render capacity: {args.renderCapacity} instances.")
-    scriptDir = os.path.realpath(os.path.dirname(__file__))
-    openspaceExec = f"{scriptDir}/{args.osdir}/{OpenSpaceExecRelativeDir}/OpenSpace.exe"
-    if not os.path.exists(openspaceExec):
+    openspaceExec = openspaceBaseDir / OpenSpaceExecRelativeDir / "OpenSpace.exe"
+    if not openspaceExec.exists():
         raise Exception(f"Could not find OpenSpace exe '{openspaceExec}'")
-    openspaceFrontendDir = f"{scriptDir}/{args.webguidir}"
-    if not os.path.exists(openspaceFrontendDir):
+    openspaceFrontendDir = ScriptDir / args.webguidir
+    if not openspaceFrontendDir.exists():
         raise Exception(f"Could not find frontend gui '{openspaceFrontendDir}'")
-    openspaceSignaling = f"{scriptDir}/{args.webguidir}/src/signalingserver"
-    if not os.path.exists(openspaceSignaling):
+    openspaceSignaling = openspaceFrontendDir / "src" / "signalingserver"
+    if not openspaceSignaling.exists():
         raise Exception(f"Could not find signaling server '{openspaceSignaling}'")
 
+    # Use the faster uvloop event loop when it is installed. Otherwise (and always on
+    # Windows) asyncio's default event loop is used
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     asyncio.run(mainAsync(
-        f"{scriptDir}/{args.osdir}",
-        openspaceFrontendDir,
-        openspaceSignaling)
+        str(openspaceFrontendDir),
+        str(openspaceSignaling))
     )
     print("Quit __main__")
@@ -1,7 +1,6 @@
-import json
+import asyncio
 import testSend as ts
 
-ts.sendMessage("{\"command\": \"SERVER_STATUS\"}")
-capacity = ts.getResult()
-jResult = json.loads(capacity)
-print(f"Found {jResult["running"]} running instance(s).")
+capacity = asyncio.run(ts.sendMessage({"command": "SERVER_STATUS"}))
+jResult = ts.jsonLoads(capacity)
+print(f"Found {jResult['running']} running instance(s).")
@@ -1,3 +1,4 @@
+import asyncio
 import testSend as ts
 
-ts.sendMessage("{\"command\": \"START\"}")
+asyncio.run(ts.sendMessage({"command": "START"}))
@@ -1,24 +1,25 @@
-import json
+import asyncio
 import sys
 import testSend as ts
 
-def getStatusForId(id):
-    ts.sendMessage("{\"command\": \"STATUS\", \"id\": " + str(id) + "}")
-    rsp = json.loads(ts.getResult())
+async def getStatusForId(websocket, id):
+    rsp = ts.jsonLoads(await ts.send(websocket, {"command": "STATUS", "id": id}))
     return rsp["status"]
 
-if len(sys.argv) > 1:
-    # If id is provided do the specific status call
-    status = getStatusForId(sys.argv[1])
-    print(f"Status of instance id {sys.argv[1]}: '{status}'")
-else:
-    # If no id provided, then find the highest non-idle id # and return its status
-    ts.sendMessage("{\"command\": \"SERVER_STATUS\"}")
-    capacity = ts.getResult()
-    jResult = json.loads(capacity)
-    for i in range(jResult["total"], 0, -1):
-        status = getStatusForId(str(i - 1))
-        if status != "IDLE":
-            print(f"Status of instance id {(i - 1)}: '{status}'")
-            quit()
-    print("No running instances found.")
\ No newline at end of file
+async def main():
+    async with ts.session() as websocket:
+        if len(sys.argv) > 1:
+            # If id is provided do the specific status call
+            status = await getStatusForId(websocket, int(sys.argv[1]))
+            print(f"Status of instance id {sys.argv[1]}: '{status}'")
+            return
+        # If no id provided, then find the highest non-idle id # and return its status
+        rsp = ts.jsonLoads(await ts.send(websocket, {"command": "STATUS_ALL"}))
+        for i in range(len(rsp["status"]), 0, -1):
+            status = rsp["status"][i - 1]
+            if status != "IDLE":
+                print(f"Status of instance id {(i - 1)}: '{status}'")
+                return
+        print("No running instances found.")
+
+asyncio.run(main())
\ No newline at end of file
@@ -1,13 +1,17 @@
-import json
+import asyncio
 import testSend as ts
 
-ts.sendMessage("{\"command\": \"SERVER_STATUS\"}")
-capacity = ts.getResult()
-jResult = json.loads(capacity)
-for i in range(jResult["total"], 0, -1):
-    ts.sendMessage("{\"command\": \"STOP\", \"id\": " + str(i - 1) + "}")
-    rsp = json.loads(ts.getResult())
-    if rsp["error"] == "none":
-        print(f"Stopped id {(i - 1)}")
-        quit()
-print("No running instances found.")
\ No newline at end of file
+async def main():
+    async with ts.session() as websocket:
+        # Only send STOP to the highest id that is not already idle
+        states = ts.jsonLoads(await ts.send(websocket, {"command": "STATUS_ALL"}))
+        for i in range(len(states["status"]), 0, -1):
+            if states["status"][i - 1] == "IDLE":
+                continue
+            rsp = ts.jsonLoads(await ts.send(websocket, {"command": "STOP", "id": i - 1}))
+            if rsp["error"] == "none":
+                print(f"Stopped id {(i - 1)}")
+                return
+        print("No running instances found.")
+
+asyncio.run(main())
\ No newline at end of file
@@ -1,31 +1,59 @@
 import asyncio
+import contextlib
 import json
+try:
+    import orjson
+except ImportError:
+    orjson = None
 import sys
 import websockets
 
 
 PrintResult = False
-Result = ""
 
 
-async def sendHandler(message):
-    global Result
+def jsonLoads(message):
+    # Parse a JSON string, using orjson if it is installed
+    if orjson:
+        return orjson.loads(message)
+    return json.loads(message)
+
+
+def jsonDumps(obj):
+    # Serialize an object to a JSON string, using orjson if it is installed
+    if orjson:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj)
+
+
+@contextlib.asynccontextmanager
+async def session():
+    """
+    Open a single websocket connection to the supervisor that can be reused for any
+    number of messages
+    """
     uri = "ws://localhost:4699"
     async with websockets.connect(uri) as websocket:
-        message = json.dumps(json.loads(message))
-        await websocket.send(message)
-        Result = await websocket.recv()
-        if PrintResult:
-            print(f"Received {str(Result)}")
+        yield websocket
 
 
-def sendMessage(msg):
-    asyncio.get_event_loop().run_until_complete(sendHandler(msg))
+async def send(websocket, msg):
+    """
+    Send a message over an open session and return the response. The message is either
+    a dict, which is serialized to JSON, or a string that is already JSON and is sent
+    as-is.
+    """
+    message = jsonDumps(msg) if isinstance(msg, dict) else msg
+    await websocket.send(message)
+    result = await websocket.recv()
+    if PrintResult:
+        print(f"Received {str(result)}")
+    return result
 
 
-def getResult():
-    global Result
-    return Result
+async def sendMessage(msg):
+    async with session() as websocket:
+        return await send(websocket, msg)
 
 
 if __name__ == "__main__":
@@ -33,4 +61,4 @@ if __name__ == "__main__":
         print("Need a JSON string to send.")
     else:
         PrintResult = True
-        sendMessage(sys.argv[1])
+        asyncio.run(sendMessage(sys.argv[1]))